@@ -0,0 +1,544 @@
+"""
+Numba-compiled search core working on bitboards.
+
+A position is described by two int64 bitboards laid out as in
+four_in_a_row.board_to_bb (rows + 1 bits per column, the bottom slot of
+column c being bit c * (rows + 1)) and an int64 array holding the number
+of discs in every column. Every score is given from the point of view of
+the player owning p, which is the player to move in negamax_bb and the max
+player in expectimax_bb.
+"""
+import numpy as np
+from numba import cfunc, njit, types
+
+# the score of a won position, above any sum of segment weights
+INF = 10 ** 9
+# below every score, so that a lost position still yields a placement, and
+# like INF within the int32 range of the stored values
+WORST = -INF - 1
+
+# flags describing how a transposition table value relates to the true score
+# EXACT: the value is the minimax value of the position
+# LOWER: the search failed high, the true value is at least the stored value
+# UPPER: the search failed low, the true value is at most the stored value
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# the number of entries of a transposition table, a power of 2 so that the
+# slot of a position is the low bits of its hash
+TT_SIZE = 1 << 20
+
+# an entry of a transposition table, a slot whose depth is -1 is empty;
+# every score fits in an int32, which packs an entry into 16 bytes
+TT_DTYPE = np.dtype([
+    ("key", np.int64), ("value", np.int32), ("depth", np.int8), ("flag", np.int8), ("move", np.int8)
+], align=True)
+# expectimax values are expectations, hence floats
+EXPECTIMAX_TT_DTYPE = np.dtype([
+    ("key", np.int64), ("value", np.float64), ("depth", np.int8), ("flag", np.int8), ("move", np.int8)
+], align=True)
+
+# Zobrist keys indexed as ZOBRIST[bit, 0] for a disc of p and ZOBRIST[bit, 1] for a disc of o
+_zobrist_rng = np.random.default_rng(3401)
+ZOBRIST = _zobrist_rng.integers(-(1 << 63), (1 << 63) - 1, size=(64, 2), dtype=np.int64)
+# XORed into the key of the positions where o is to move
+ZOBRIST_SIDE = int(_zobrist_rng.integers(-(1 << 63), (1 << 63) - 1, dtype=np.int64))
+# XORed into the hashes of the positions of a rows x cols board as ZOBRIST_SIZE[rows, cols],
+# so that the boards of different sizes do not share their entries
+ZOBRIST_SIZE = _zobrist_rng.integers(-(1 << 63), (1 << 63) - 1, size=(64, 64), dtype=np.int64)
+
+
+def new_transposition_table(dtype=TT_DTYPE, size=TT_SIZE):
+    """
+    Allocate an empty transposition table
+    """
+    tt = np.zeros(size, dtype)
+    tt["depth"] = -1
+    return tt
+
+
+# minimax and alphabeta compute the same values, so they share a table
+MINIMAX_TT = new_transposition_table()
+EXPECTIMAX_TT = new_transposition_table(EXPECTIMAX_TT_DTYPE)
+
+
+def clear_transposition_table(tt):
+    """
+    Forget every position stored in a transposition table
+    """
+    tt["depth"] = -1
+
+
+def clear_transposition_tables():
+    """
+    Forget every position stored in the transposition tables
+    """
+    clear_transposition_table(MINIMAX_TT)
+    clear_transposition_table(EXPECTIMAX_TT)
+
+
+def board_mask(rows, cols):
+    """
+    Get the bitboard with every slot of a rows x cols board set
+    """
+    column = (1 << rows) - 1
+    mask = 0
+    for c in range(cols):
+        mask |= column << (c * (rows + 1))
+    return mask
+
+
+# the segment starts of every board size seen so far, keyed by (rows, cols)
+_SEGMENTS_CACHE = {}
+
+
+def segment_starts(rows, cols):
+    """
+    Get the bitboards of the first slots of the 4-slot segments lying entirely
+    on a rows x cols board, for the col, row, slash and backslash directions
+    (shifts of 1, rows + 1, rows and rows + 2 bits).
+    They are computed once per board size, the returned array must not be modified.
+    """
+    starts = _SEGMENTS_CACHE.get((rows, cols))
+    if starts is None:
+        height = rows + 1
+        on_board = board_mask(rows, cols)
+        starts = np.empty(4, np.int64)
+        for i, shift in enumerate((1, height, height - 1, height + 1)):
+            starts[i] = on_board & (on_board >> shift) & (on_board >> 2 * shift) & (on_board >> 3 * shift)
+        _SEGMENTS_CACHE[(rows, cols)] = starts
+    return starts
+
+
+@njit(cache=True)
+def popcount(x):
+    """
+    Count the set bits of a non-negative int64
+    """
+    x = x - ((x >> 1) & 0x5555555555555555)
+    x = (x & 0x3333333333333333) + ((x >> 2) & 0x3333333333333333)
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0F
+    x = x + (x >> 8)
+    x = x + (x >> 16)
+    x = x + (x >> 32)
+    return x & 0x7F
+
+
+@njit(cache=True)
+def weighted_segments(ones, twos, mask):
+    """
+    Get the weighted number of the segments of mask, given the bit-sliced disc
+    counts of every segment. See four_in_a_row.evaluate for the weights; the
+    segments of four discs are not counted, they end the game before.
+    """
+    return popcount(ones & ~twos & mask) + 4 * popcount(twos & ~ones & mask) + 16 * popcount(ones & twos & mask)
+
+
+# The evaluation of the segments of one direction, written once per direction
+# by evaluator_source with the shift and the segment starts as constants
+_DIRECTION_SOURCE = """\
+    # the 4 slots of every segment, aligned on the first slot
+    a = occupied & {start}
+    b = (occupied >> {shift}) & {start}
+    c = (occupied >> {shift2}) & {start}
+    d = (occupied >> {shift3}) & {start}
+    # add the 4 slots bit by bit so that the disc count of every segment
+    # is spread over the ones, twos and fours bitboards
+    ab_ones = a ^ b
+    cd_ones = c ^ d
+    ab_twos = a & b
+    cd_twos = c & d
+    ones = ab_ones ^ cd_ones
+    twos = ab_twos ^ cd_twos ^ (ab_ones & cd_ones)
+    fours = ab_twos & cd_twos
+    # a segment without discs of one player holds as many discs of the
+    # other one as occupied slots, so one count serves both players
+    p_any = p | (p >> {shift}) | (p >> {shift2}) | (p >> {shift3})
+    o_any = o | (o >> {shift}) | (o >> {shift2}) | (o >> {shift3})
+    # four in a row ends the game, whatever the other segments hold
+    if fours & ~p_any:
+        return -INF
+    if fours & ~o_any:
+        return INF
+    score += weighted_segments(ones, twos, ~o_any) - weighted_segments(ones, twos, ~p_any)
+"""
+
+# the signature of the evaluators returned by evaluator, taking the bitboards p and o
+EVALUATOR_SIGNATURE = types.int64(types.int64, types.int64)
+
+# the evaluators of every board size seen so far, keyed by (rows, cols)
+_EVALUATORS_CACHE = {}
+
+
+def evaluator_source(rows, cols):
+    """
+    Get the source of the evaluator of a rows x cols board: _DIRECTION_SOURCE
+    written out for the col, row, slash and backslash directions, with their
+    shifts and segment starts as constants
+    """
+    height = rows + 1
+    source = "def evaluate_{}x{}(p, o):\n    occupied = p | o\n    score = 0\n".format(rows, cols)
+    for shift, start in zip((1, height, height - 1, height + 1), segment_starts(rows, cols)):
+        source += _DIRECTION_SOURCE.format(start=int(start), shift=shift, shift2=2 * shift, shift3=3 * shift)
+    return source + "    return score\n"
+
+
+def evaluator(rows, cols):
+    """
+    Get the evaluator of a rows x cols board, compiled once per board size
+    into a function of (p, o) giving the advantage of the player owning p, as
+    four_in_a_row.evaluate does. A won position scores INF and a lost one -INF.
+    The search kernels take it as a first-class function of type
+    EVALUATOR_SIGNATURE, so that a single compiled kernel, cached by Numba,
+    serves every board size. Python code calls it through its ctypes attribute.
+    """
+    evaluate = _EVALUATORS_CACHE.get((rows, cols))
+    if evaluate is None:
+        namespace = {"INF": INF, "weighted_segments": weighted_segments}
+        exec(evaluator_source(rows, cols), namespace)
+        evaluate = cfunc(EVALUATOR_SIGNATURE)(namespace["evaluate_{}x{}".format(rows, cols)])
+        _EVALUATORS_CACHE[(rows, cols)] = evaluate
+    return evaluate
+
+
+@njit(cache=True)
+def has_four(bb, rows):
+    """
+    Check if a bitboard holds four discs in a row. The sentinel bit on top of
+    every column is never set, so no line can wrap around a column.
+    """
+    height = rows + 1
+    for shift in (1, height, height - 1, height + 1):
+        m = bb & (bb >> shift)
+        if m & (m >> 2 * shift):
+            return True
+    return False
+
+
+@njit(cache=True)
+def is_terminal(p, o, rows, cols):
+    """
+    Check if someone has won or the board is full
+    """
+    return has_four(p, rows) or has_four(o, rows) or popcount(p | o) == rows * cols
+
+
+@njit(cache=True)
+def zobrist_bb(p, o):
+    """
+    Compute the Zobrist hash of a position from scratch
+    """
+    h = 0
+    for bit in range(64):
+        if (p >> bit) & 1:
+            h ^= ZOBRIST[bit, 0]
+        elif (o >> bit) & 1:
+            h ^= ZOBRIST[bit, 1]
+    return h
+
+
+@njit(cache=True)
+def mirror_bb(bb, rows, cols):
+    """
+    Mirror a bitboard left to right by swapping its column lanes
+    """
+    height = rows + 1
+    lane = (1 << height) - 1
+    mirrored = 0
+    for c in range(cols):
+        mirrored |= ((bb >> (c * height)) & lane) << ((cols - 1 - c) * height)
+    return mirrored
+
+
+@njit(cache=True)
+def zobrist_hashes(p, o, rows, cols):
+    """
+    Compute the Zobrist hashes of a position and of its mirror image from scratch
+    """
+    size = ZOBRIST_SIZE[rows, cols]
+    return zobrist_bb(p, o) ^ size, zobrist_bb(mirror_bb(p, rows, cols), mirror_bb(o, rows, cols)) ^ size
+
+
+@njit(cache=True)
+def tt_key(h, hm, maximizing):
+    """
+    Get the transposition table key of a position from its Zobrist hash h and
+    the hash hm of its mirror image, which has the same value. The smallest of
+    both is used, so that a position and its mirror image share their entry.
+    """
+    key = min(h, hm)
+    if not maximizing:
+        key ^= ZOBRIST_SIDE
+    return key
+
+
+@njit(cache=True)
+def tt_move(move, mirrored, cols):
+    """
+    Convert a move between a position and its entry, which belongs to its
+    mirror image if mirrored (hm < h)
+    """
+    if mirrored and move >= 0:
+        return cols - 1 - move
+    return move
+
+
+@njit(cache=True)
+def make_move(heights, col, rows):
+    """
+    Place a disc at the given column, updating heights in place
+
+    Returns
+    -------
+    the index of the bit of the new disc
+    """
+    bit = col * (rows + 1) + heights[col]
+    heights[col] += 1
+    return bit
+
+
+@njit(cache=True)
+def mirror_bit(bit, col, rows, cols):
+    """
+    Get the index of the bit mirroring a slot of the given column
+    """
+    return bit + (cols - 1 - 2 * col) * (rows + 1)
+
+
+@njit(cache=True)
+def undo_move(heights, col):
+    """
+    Remove the top disc of the given column, updating heights in place
+    """
+    heights[col] -= 1
+
+
+@njit(cache=True)
+def tt_cutoff(entry, depth, alpha, beta):
+    """
+    Check if a transposition table entry can replace a search to the given
+    depth with the (alpha, beta) window
+    """
+    if entry.depth < depth:
+        return False
+    if entry.flag == EXACT:
+        return True
+    if entry.flag == LOWER:
+        return entry.value >= beta
+    return entry.value <= alpha
+
+
+@njit(cache=True)
+def tt_store(entry, key, depth, flag, value, move):
+    """
+    Overwrite a transposition table entry
+    """
+    entry.key = key
+    entry.depth = depth
+    entry.flag = flag
+    entry.value = value
+    entry.move = move
+
+
+@njit(cache=True)
+def order_moves(p, o, heights, rows, cols, evaluate, depth, tt_best, killers, history, moves):
+    """
+    Fill moves with the legal columns, the most promising for the player
+    owning p first: the transposition table move, then the best one-ply
+    evaluation (skipped at depth <= 2 where it costs more than it saves), then
+    the two killer moves, then the columns with the best history, then the
+    columns closer to the center. The killers and history only break the ties
+    of the evaluation, which finds better moves when it is computed.
+
+    Parameters
+    ----------
+    killers: the two last moves that caused a cutoff at this depth
+    history: the cutoff score of every column for the player to move
+
+    Returns
+    -------
+    the number of legal columns
+    """
+    keys = np.empty(cols, np.int64)
+    evals = np.zeros(cols, np.int64)
+    n = 0
+    for col in range(cols):
+        if heights[col] == rows:
+            continue
+        if col == killers[0]:
+            key = 2 << 56
+        elif col == killers[1]:
+            key = 1 << 56
+        else:
+            key = history[col] * cols + min(col, cols - 1 - col)
+        value = 0
+        if col == tt_best:
+            value = INF + 1  # above every evaluation
+        elif depth > 2:
+            value = evaluate(p | (1 << (col * (rows + 1) + heights[col])), o)
+        # insertion sort, stable so that ties keep the left to right order
+        i = n
+        while i > 0 and (evals[i - 1] < value or (evals[i - 1] == value and keys[i - 1] < key)):
+            moves[i] = moves[i - 1]
+            keys[i] = keys[i - 1]
+            evals[i] = evals[i - 1]
+            i -= 1
+        moves[i] = col
+        keys[i] = key
+        evals[i] = value
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def negamax_bb(p, o, h, hm, heights, rows, cols, evaluate, depth, alpha, beta, side, prune, tt, killers, history):
+    """
+    Depth-limited negamax search: the score of a position for the player to
+    move is the opposite of the lowest score of its children for the adversary.
+
+    Parameters
+    ----------
+    p, o: int
+        the bitboards of the player to move and its adversary
+    h: int
+        the Zobrist hash of the position, in which the discs of the max player
+        of the search use the keys ZOBRIST[:, 0] and the others ZOBRIST[:, 1]
+    hm: int
+        the Zobrist hash of the mirror image of the position
+    heights: the number of discs in every column
+    rows, cols: int
+        the size of the board
+    evaluate: the evaluator of the board size, given by evaluator(rows, cols)
+    depth: int
+        the remaining search depth
+    alpha, beta: int
+        the search window, for the player to move
+    side: int
+        0 if the max player is to move, 1 otherwise
+    prune: bool
+        True for an alpha-beta search trying the most promising moves first,
+        False for a plain minimax search trying the moves from left to right
+    tt: the transposition table
+    killers: an int64 array of shape (depth + 1, 2), filled with -1 before the first call
+        the two last moves that caused a cutoff at every depth
+    history: an int64 array of shape (2, cols), filled with 0 before the first call
+        the cutoff score of every column for the max player (row 0) and its adversary (row 1)
+
+    Returns
+    -------
+    (placement, score): the best column (-1 at leaves) and its score for the
+    player to move. When pruning, the score is a lower bound if it is >= beta
+    and an upper bound if it is <= alpha.
+    """
+    # the leaves skip the terminal test, the evaluators score won positions INF
+    if depth == 0 or is_terminal(p, o, rows, cols):
+        return -1, evaluate(p, o)
+
+    key = tt_key(h, hm, side == 0)
+    mirrored = hm < h
+    entry = tt[key & (tt.size - 1)]
+    tt_best = -1
+    if entry.key == key:
+        if tt_cutoff(entry, depth, alpha, beta):
+            return tt_move(entry.move, mirrored, cols), entry.value
+        tt_best = tt_move(entry.move, mirrored, cols)
+
+    alpha0 = alpha
+    moves = np.empty(cols, np.int64)
+    if prune:
+        n = order_moves(p, o, heights, rows, cols, evaluate, depth, tt_best, killers[depth], history[side], moves)
+    else:
+        n = 0
+        for col in range(cols):
+            if heights[col] < rows:
+                moves[n] = col
+                n += 1
+    placement = -1
+    local_best = WORST
+    for i in range(n):
+        col = moves[i]
+        bit = make_move(heights, col, rows)
+        mbit = mirror_bit(bit, col, rows, cols)
+        score = -negamax_bb(o, p | (1 << bit), h ^ ZOBRIST[bit, side], hm ^ ZOBRIST[mbit, side],
+                            heights, rows, cols, evaluate, depth - 1, -beta, -alpha, 1 - side, prune,
+                            tt, killers, history)[1]
+        undo_move(heights, col)
+        if score > local_best:
+            placement = col
+            local_best = score
+        if prune:
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                if killers[depth, 0] != col:
+                    killers[depth, 1] = killers[depth, 0]
+                    killers[depth, 0] = col
+                history[side, col] += depth * depth
+                break
+
+    if local_best <= alpha0:
+        flag = UPPER
+    elif local_best >= beta:
+        flag = LOWER
+    else:
+        flag = EXACT
+    tt_store(entry, key, depth, flag, local_best, tt_move(placement, mirrored, cols))
+    return placement, local_best
+
+
+@njit(cache=True)
+def expectimax_bb(p, o, h, hm, heights, rows, cols, evaluate, depth, maximizing, tt):
+    """
+    Expectimax search where the adversary picks its moves uniformly at random.
+    It is kept apart from negamax_bb since chance nodes are not symmetric.
+
+    Parameters
+    ----------
+    p, o: int
+        the bitboards of the max player and its adversary, the scores being
+        given for the max player
+    maximizing: bool
+        True if the max player is to move, False at chance nodes
+    see negamax_bb for the other parameters
+    """
+    # the leaves skip the terminal test, the evaluators score won positions INF
+    if depth == 0 or is_terminal(p, o, rows, cols):
+        return -1, float(evaluate(p, o))
+
+    key = tt_key(h, hm, maximizing)
+    mirrored = hm < h
+    entry = tt[key & (tt.size - 1)]
+    if entry.key == key and entry.depth >= depth:
+        return tt_move(entry.move, mirrored, cols), entry.value
+
+    placement = -1
+    if maximizing:
+        local_max = float(WORST)
+        for col in range(cols):
+            if heights[col] == rows:
+                continue
+            bit = make_move(heights, col, rows)
+            mbit = mirror_bit(bit, col, rows, cols)
+            score = expectimax_bb(p | (1 << bit), o, h ^ ZOBRIST[bit, 0], hm ^ ZOBRIST[mbit, 0],
+                                  heights, rows, cols, evaluate, depth - 1, not maximizing, tt)[1]
+            undo_move(heights, col)
+            if score > local_max:
+                placement = col
+                local_max = score
+        value = local_max
+    else:
+        # the moves are equally likely, so the expectation is the mean of the
+        # child values, divided once by their number
+        total = 0.0
+        n = 0
+        for col in range(cols):
+            if heights[col] == rows:
+                continue
+            bit = make_move(heights, col, rows)
+            mbit = mirror_bit(bit, col, rows, cols)
+            total += expectimax_bb(p, o | (1 << bit), h ^ ZOBRIST[bit, 1], hm ^ ZOBRIST[mbit, 1],
+                                   heights, rows, cols, evaluate, depth - 1, not maximizing, tt)[1]
+            undo_move(heights, col)
+            n += 1
+        value = total / n
+
+    tt_store(entry, key, depth, EXACT, value, tt_move(placement, mirrored, cols))
+    return placement, value
@@ -1,12 +1,21 @@
 # use math library if needed
+import functools
 import math
-import sys
-from collections import defaultdict
+
+import numpy as np
+
+import core_nb
+
+# the half-width of the first aspiration window of every iterative deepening search
+ASPIRATION_DELTA = 50
+
+# the adversary of every player, filled from the board constants by the first call to next_player
+NEXT_PLAYER = None
 
 
 def get_child_boards(player, board):
     """
-    Generate a list of succesor boards obtained by placing a disc 
+    Generate the succesor boards obtained by placing a disc 
     at the given board for a given player
    
     Parameters
@@ -15,19 +24,117 @@ def get_child_boards(player, board):
         the player that will place a disc on the board
     board: the current board instance
 
-    Returns
-    -------
-    a list of (col, new_board) tuples,
+    Yields
+    ------
+    (col, new_board) tuples,
     where col is the column in which a new disc is placed (left column has a 0 index), 
-    and new_board is the resulting board instance
+    and new_board is the resulting board instance,
+    cloned only once the caller asks for it so that a loop cut short skips the remaining clones
     """
-    res = []
     for c in range(board.cols):
         if board.placeable(c):
             tmp_board = board.clone()
             tmp_board.place(player, c)
-            res.append((c, tmp_board))
-    return res
+            yield c, tmp_board
+
+
+# the byte standing for the sentinel slot on top of every column, never a player
+SENTINEL_SLOT = b"\xff"
+
+
+@functools.lru_cache(maxsize=None)
+def bit_table(player):
+    """
+    Get the bytes.translate table turning the slots of player into b"1" and
+    every other slot into b"0"
+    """
+    table = bytearray(b"0" * 256)
+    table[player] = ord("1")
+    return bytes(table)
+
+
+def board_key(board):
+    """
+    Get the bytes of the rows of a board, from the top one
+    """
+    return b"".join([bytes(board.row(r)) for r in range(board.rows)])
+
+
+def bytes_to_bb(key, rows, cols, player1, player2):
+    """
+    Pack a board, given as the bytes of its rows from the top one, into two
+    bitboards, see board_to_bb
+    """
+    # key[c::cols] is column c from the top slot down, so joining the columns
+    # from the right one, each topped with its sentinel, spells out the bits of
+    # the bitboard in binary from the most significant one
+    columns = SENTINEL_SLOT.join([key[c::cols] for c in range(cols - 1, -1, -1)])
+    return int(columns.translate(bit_table(player1)), 2), int(columns.translate(bit_table(player2)), 2)
+
+
+def board_to_bb(board):
+    """
+    Pack a board into two bitboards, one per player.
+
+    Each column takes rows + 1 bits, the bottom slot of column c being bit
+    c * (rows + 1) and the extra top bit a sentinel that is never set, so that
+    a 6x7 board uses 49 bits.
+
+    Parameters
+    ----------
+    board: the board instance
+
+    Returns
+    -------
+    (p1_bb, p2_bb): int, int
+        the bitboards of the slots occupied by board.PLAYER1 and board.PLAYER2
+    """
+    return bytes_to_bb(board_key(board), board.rows, board.cols, board.PLAYER1, board.PLAYER2)
+
+
+def check_bitboard_size(rows, cols):
+    """
+    Raise ValueError if a board does not fit in the 64-bit bitboards of core_nb
+    """
+    if (rows + 1) * cols > 63:
+        raise ValueError("A {}x{} board does not fit in a 64-bit bitboard.".format(rows, cols))
+
+
+def next_player(board, player):
+    """
+    Get the adversary of the given player
+    """
+    global NEXT_PLAYER
+    if NEXT_PLAYER is None:
+        NEXT_PLAYER = {board.PLAYER1: board.PLAYER2, board.PLAYER2: board.PLAYER1}
+    return NEXT_PLAYER[player]
+
+
+def bitboard_state(player, board):
+    """
+    Convert a board to the state searched by the core_nb kernels
+
+    Parameters
+    ----------
+    player: board.PLAYER1 or board.PLAYER2
+        the player whose discs go to the first bitboard
+    board: the board instance
+
+    Returns
+    -------
+    (p, o, heights): the bitboards of player and its adversary, and an int64
+    array of the number of discs in every column
+    """
+    rows, cols = board.rows, board.cols
+    height = rows + 1
+    check_bitboard_size(rows, cols)
+    p1_bb, p2_bb = board_to_bb(board)
+    discs = {board.PLAYER1: p1_bb, board.PLAYER2: p2_bb}
+    p, o = discs[player], discs[next_player(board, player)]
+    occupied = p | o
+    column = (1 << rows) - 1
+    heights = np.array([((occupied >> (c * height)) & column).bit_count() for c in range(cols)], dtype=np.int64)
+    return p, o, heights
 
 
 def evaluate(player, board):
@@ -47,63 +154,26 @@ def evaluate(player, board):
         a scalar to evaluate the advantage of the specific player at the given
         game board
     """
-    adversary = board.PLAYER2 if player == board.PLAYER1 else board.PLAYER1
-    # Initialize the value of scores
-    # [s0, s1, s2, s3, --s4--]
-    # s0 for the case where all slots are empty in a 4-slot segment
-    # s1 for the case where the player occupies one slot in a 4-slot line, the rest are empty
-    # s2 for two slots occupied
-    # s3 for three
-    # s4 for four
-    score = [0] * 5
-    adv_score = [0] * 5
-
-    # Initialize the weights
-    # [w0, w1, w2, w3, --w4--]
-    # w0 for s0, w1 for s1, w2 for s2, w3 for s3
-    # w4 for s4
-    weights = [0, 1, 4, 16, 1000]
-
-    # Obtain all 4-slot segments on the board
-    seg = []
-    invalid_slot = -1
-    left_revolved = [
-        [invalid_slot] * r + board.row(r) + \
-        [invalid_slot] * (board.rows - 1 - r) for r in range(board.rows)
-    ]
-    right_revolved = [
-        [invalid_slot] * (board.rows - 1 - r) + board.row(r) + \
-        [invalid_slot] * r for r in range(board.rows)
-    ]
-    for r in range(board.rows):
-        # row
-        row = board.row(r)
-        for c in range(board.cols - 3):
-            seg.append(row[c:c + 4])
-    for c in range(board.cols):
-        # col
-        col = board.col(c)
-        for r in range(board.rows - 3):
-            seg.append(col[r:r + 4])
-    for c in zip(*left_revolved):
-        # slash
-        for r in range(board.rows - 3):
-            seg.append(c[r:r + 4])
-    for c in zip(*right_revolved):
-        # backslash
-        for r in range(board.rows - 3):
-            seg.append(c[r:r + 4])
-    # compute score
-    for s in seg:
-        if invalid_slot in s:
-            continue
-        if adversary not in s:
-            score[s.count(player)] += 1
-        if player not in s:
-            adv_score[s.count(adversary)] += 1
-    reward = sum([s * w for s, w in zip(score, weights)])
-    penalty = sum([s * w for s, w in zip(adv_score, weights)])
-    return reward - penalty
+    # The score sums, over all 4-slot segments, the weight of the number of
+    # discs of a player in the segments holding no disc of the other one
+    # [w0, w1, w2, w3] = [0, 1, 4, 16]
+    # w0 for all slots empty, w1 for one slot occupied, ..., and w3 for three
+    # A board where someone has four in a row ends the game and scores
+    # +-core_nb.INF instead
+    # The scores are cached on the bytes of the board rows
+    return _evaluate_cached(player, next_player(board, player), board.rows, board.cols, board_key(board))
+
+
+@functools.lru_cache(maxsize=1 << 12)
+def _evaluate_cached(player, adversary, rows, cols, key):
+    """
+    Score the board whose rows, from the top one, are packed in key, see evaluate.
+    The searches score their positions in core_nb, so the cache only serves
+    the callers of evaluate outside this module and is kept small.
+    """
+    check_bitboard_size(rows, cols)
+    p, o = bytes_to_bb(key, rows, cols, player, adversary)
+    return int(core_nb.evaluator(rows, cols).ctypes(p, o))
 
 
 def minimax(player, board, depth_limit):
@@ -126,93 +196,19 @@ def minimax(player, board, depth_limit):
         (counted from the most left as 0)
         None to give up the game
     """
-    max_player = player
-    next_player = board.PLAYER2 if player == board.PLAYER1 else board.PLAYER1
-
-    # ## Please finish the code below ##############################################
-    # ##############################################################################
-    # ## Sub-Function ##############################################################
-
-    # ******************************************************************************
-    # value*************************************************************************
-
-    def value(player, board, depth_limit):
-        """
-        acting as a highway function for the minmax algorithm, the board game hasn't ended
-        or the depth_limit is not 0 then run the max_value and min_value
-        :param player: is the current player turn in the given game
-        :param board: is the current board in which the player exist
-        :param depth_limit: is the level in which we traversed in the tree
-        :return the best possible placement in the current board
-        """
-        if depth_limit == 0 or board.terminal():
-            if board.terminal():
-                if board.who_wins() == max_player:
-                    # if the board is in a terminal states and the max player
-                    # has won then return an evaluation
-                    return None, evaluate(max_player, board)
-                elif board.who_wins() == next_player:
-                    # if the board is in a terminal states and the other player
-                    # has won then return an evaluation
-                    return None, evaluate(max_player, board)
-                else:  # if the board is terminal and there is no winner return 0 as there is no possible states
-                    return None, evaluate(max_player, board)
-            else:  # at depth 0 and the board is not in terminal state then return the score
-                return None, evaluate(max_player, board)
-
-        if max_player == player:  # if the current player is max_player
-            return max_value(player, board, depth_limit)
-        else:
-            return min_value(player, board, depth_limit)
-
-    # ******************************************************************************
-    # Max value*********************************************************************
-    def max_value(player, board, depth_limit):
-        """
-        find the maximum possible placement, score value of the given board
-
-        :param player: the max player on the given call
-        :param board: the current board state
-        :param depth_limit: the depth in which player is on the tree
-        :return: the maximum possible placement on the board and score
-        """
-        placement = None
-        local_max = -sys.maxsize  # assign the local max to smallest number
-        for i, move in get_child_boards(player, board):  # loop through all the child boards
-            score = value(next_player, move, depth_limit - 1)[1]
-
-            if score > local_max:  # if the current score is greater the local max
-                placement = i  # set the placement to the column
-                local_max = score  # set the local max to the current score
-
-        return placement, local_max
-
-    # *****************************************************************************
-    # Min value********************************************************************
-    def min_value(player, board, depth_limit):
-        """
-        find the minimum possible placement, score value of the given board
-
-        :param player: the min player on the given call
-        :param board: the current board state
-        :param depth_limit: the depth in which player is on the tree
-        :return: the minimum possible placement on the board and score
-        """
-        placement = None
-        local_min = sys.maxsize
-        for i, move in get_child_boards(player, board):
-            score = value(max_player, move, depth_limit - 1)[1]
-
-            if score < local_min:  # if the current score is less the local min
-                placement = i  # set the placement to the column
-                local_min = score  # set the local min to the current score
-
-        return placement, local_min
-
-    ###############################################################################
-    ###############################################################################
-
-    return value(player, board, depth_limit)[0]
+    p, o, heights = bitboard_state(player, board)
+    h, hm = core_nb.zobrist_hashes(p, o, board.rows, board.cols)
+    # the entries of earlier searches may come from deeper searches, which
+    # would make the result depend on them rather than on depth_limit
+    core_nb.clear_transposition_table(core_nb.MINIMAX_TT)
+    # a plain minimax search never updates the killers and history
+    killers = np.full((depth_limit + 1, 2), -1, dtype=np.int64)
+    history = np.zeros((2, board.cols), dtype=np.int64)
+    placement, _ = core_nb.negamax_bb(
+        p, o, h, hm, heights, board.rows, board.cols, core_nb.evaluator(board.rows, board.cols),
+        depth_limit, core_nb.WORST, -core_nb.WORST, 0, False, core_nb.MINIMAX_TT, killers, history
+    )
+    return None if placement < 0 else int(placement)
 
 
 def alphabeta(player, board, depth_limit):
@@ -237,128 +233,36 @@ def alphabeta(player, board, depth_limit):
         (counted from the most left as 0)
         None to give up the game
     """
-    max_player = player
-    next_player = board.PLAYER2 if player == board.PLAYER1 else board.PLAYER1
-
-    # ## Please finish the code below ##############################################
-    # ##############################################################################
-    # ## Sub-Function ##############################################################
-
-    # ******************************************************************************
-    # value*************************************************************************
-    def value(player, board, depth, alpha, beta):
-        """
-        acting as a highway function for the expected-max algorithm, the board game hasn't ended
-        or the depth_limit is not 0 then run the max_value and min_value
-        :param player: is the current player turn in the given game
-        :param board: is the current board in which the player exist
-        :param depth: is the level in which we traversed in the tree
-        :param alpha: Initially, alpha is negative infinity as we transcend through max_value we will update
-                      and we will prune nodes given we have a alpha >= beta
-        :param beta:  Initially, positive infinity as we transcend through min_value we will update
-                      and we will prune nodes given we have a alpha >= beta
-        :return: the maximum possible placement on the board
-        """
-
-        if depth == 0 or board.terminal():
-            if board.terminal():
-
-                if board.who_wins() == next_player:
-                    # if the board is in a terminal states and the other player
-                    # has won then return an evaluation
-                    return None, evaluate(max_player, board)
-
-                elif board.who_wins() == max_player:
-                    return None, evaluate(max_player, board)
-
-                else:  # if the boarqd is terminal and there is no winner return 0 as there is no possible states
-                    return None, evaluate(max_player, board)
-            else:  # at depth 0 and the board is not in terminal state then return the score
-                return None, evaluate(max_player, board)
-
-        else:
-            if max_player == player:
-                return max_value(player, board, depth, alpha, beta)
-            else:
-                return min_value(player, board, depth, alpha, beta)
-
-    # ******************************************************************************
-    # Max value*********************************************************************
-    def max_value(player_max, board_max, depth, alpha, beta):
-        """
-        find the maximum possible placement, score value of the given board
-
-        :param player_max: the max player on the given call
-        :param board_max: the current board state
-        :param depth: the depth in which player is on the tree
-        :param alpha: Initially, alpha is negative infinity as we transcend through max_value we will update
-                      and we will prune nodes given we have a alpha >= beta
-        :param beta:  Initially, positive infinity as we transcend through min_value we will update
-                      and we will prune nodes given we have a alpha >= beta
-        :return: the maximum possible placement on the board
-        """
-        local_max = -sys.maxsize
-        placement = None
-        # dict = defaultdict(list)  # --TEST--
-        for i, move in get_child_boards(player_max, board_max):
-            score = value(next_player, move, depth - 1, alpha, beta)[1]
-
-            # **********************************
-            # TESTING***************************
-            # dict[str(score)].append(i)
-            # **********************************
-
-            if score > local_max:  # if the current score is greater the local max
-                placement = i  # set the placement to the column
-                local_max = score  # set the local max to the current score
-
-            alpha = max(alpha, score)
-            if alpha >= beta:  # https://en.wikipedia.org/wiki/Alpha%E2%80%93beta_pruning
-                break  # coped from the wiki page Alpha–beta pruning
-
-        # print("max:", dict)  # TESTING
-        return placement, local_max
-
-    # *****************************************************************************
-    # Min value********************************************************************
-    def min_value(min_player, board_min, depth, alpha, beta):
-        """
-        find the minimum possible placement, score value of the given board
-
-        :param beta:
-        :param alpha:
-        :param min_player: the min player on the given call
-        :param board_min: the current board state
-        :param depth: the depth in which player is on the tree
-        :return: the minimum possible placement on the board
-        """
-
-        placement = None
-        local_min = sys.maxsize
-        # list_min = [] --TEST--
-        for i, move in get_child_boards(min_player, board_min):
-            score = value(max_player, move, depth - 1, alpha, beta)[1]
-
-            # **********************************
-            # TESTING***************************
-            # list_min.append(score) --TEST--
-            # **********************************
-
-            if score < local_min:  # if the current score is less the local min
-                placement = i  # set the placement to the column
-                local_min = score  # set the local min to the current score
-
-            beta = min(beta, score)
-            if beta <= alpha:  # https://en.wikipedia.org/wiki/Alpha%E2%80%93beta_pruning
-                break  # coped from the wiki page Alpha–beta pruning
-
-        # print("min: ", list_min) # --TEST--
-        return placement, local_min
-
-    ###############################################################################
-    ###############################################################################
-
-    return value(player, board, depth_limit, -sys.maxsize, sys.maxsize)[0]
+    p, o, heights = bitboard_state(player, board)
+    h, hm = core_nb.zobrist_hashes(p, o, board.rows, board.cols)
+    evaluator = core_nb.evaluator(board.rows, board.cols)
+    # the iterations only share the entries of this search, see minimax
+    core_nb.clear_transposition_table(core_nb.MINIMAX_TT)
+
+    # Iterative deepening: every iteration fills the transposition table with
+    # the best moves searched first by the next, deeper one. Each search starts
+    # with a window around the previous score, widened until the score lies
+    # strictly inside it. A won or lost position scores exactly +-core_nb.INF,
+    # which is final even outside the window.
+    # the killer moves of every depth and the history of every column,
+    # shared by all iterations
+    killers = np.full((depth_limit + 1, 2), -1, dtype=np.int64)
+    history = np.zeros((2, board.cols), dtype=np.int64)
+    placement = -1
+    prev_score = 0
+    for depth in range(1, depth_limit + 1):
+        delta = ASPIRATION_DELTA
+        while True:
+            alpha, beta = prev_score - delta, prev_score + delta
+            placement, score = core_nb.negamax_bb(
+                p, o, h, hm, heights, board.rows, board.cols, evaluator, depth, alpha, beta, 0, True,
+                core_nb.MINIMAX_TT, killers, history
+            )
+            if alpha < score < beta or abs(score) >= core_nb.INF:
+                break
+            delta *= 2
+        prev_score = score
+    return None if placement < 0 else int(placement)
 
 
 def expectimax(player, board, depth_limit):
@@ -386,88 +290,15 @@ def expectimax(player, board, depth_limit):
         (counted from the most left as 0)
         None to give up the game
     """
-
-    max_player = player
-    next_player = board.PLAYER2 if player == board.PLAYER1 else board.PLAYER1
-
-    # ## Please finish the code below ##############################################
-    # ##############################################################################
-    # ## Sub-Function ##############################################################
-
-    # *****************************************************************************
-    # Value********************************************************************
-    def value(player, board, depth_limit):
-        """
-        acting as a highway function for the expected-max algorithm, the board game hasn't ended
-        or the depth_limit is not 0 then run the max_value and min_value
-        :param player: is the current player turn in the given game
-        :param board: is the current board in which the player exist
-        :param depth_limit: is the level in which we traversed in the tree
-        """
-        if depth_limit == 0 or board.terminal():
-            if board.terminal():
-                if board.who_wins() == max_player:
-                    return None, evaluate(max_player, board)
-                elif board.who_wins() == next_player:
-                    # if the board is in a terminal states and the other player
-                    # has won then return an evaluation
-                    return None, evaluate(max_player, board)
-                else:  # if the board is terminal and there is no winner return 0 as there is no possible states
-                    return None, evaluate(max_player, board)
-            else:  # at depth 0 and the board is not in terminal state then return the score
-                return None, evaluate(max_player, board)
-
-        if max_player == player:
-            return max_value(player, board, depth_limit)
-        else:
-            return min_value(player, board, depth_limit)
-
-    # *****************************************************************************
-    # Max value********************************************************************
-    def max_value(player, board, depth_limit):
-        """
-        find the maximum possible placement, score value of the given board
-
-        :param player: the max player on the given call
-        :param board: the current board state
-        :param depth_limit: the depth in which player is on the tree
-        :return: the maximum possible placement on the board
-        """
-        local_max = -sys.maxsize
-        placement = None
-        for i, move in get_child_boards(player, board):
-            score = value(next_player, move, depth_limit - 1)[1]
-
-            if score > local_max:  # if the current score is greater the local max
-                placement = i  # set the placement to the column
-                local_max = score  # set the local max to the current score
-
-        return placement, local_max
-
-    # *****************************************************************************
-    # Min value********************************************************************
-    def min_value(player, board, depth_limit):
-        """
-        getting the expected value of the given distribution of given moves for the
-        adversely agent
-
-        :param player: the min player on the given call
-        :param board: the current board state
-        :param depth_limit: the depth in which player is on the tree
-        :return: the minimum possible placement on the board
-        """
-        moves = get_child_boards(player, board)  # get the list of moves the adversely agent can make
-        p = 1 / len(moves)  # the uniform probability of the moves
-        expected_value = 0  # expected value of the given min
-        for i, move in moves:
-            expected_value += p * value(max_player, move, depth_limit - 1)[1] # summation of
-            # E[x] = p(X=move_0) * score + ... + p(X=move_i) * score
-        return None, expected_value
-
-    ###############################################################################
-    ###############################################################################
-
-    return value(player, board, depth_limit)[0]
+    p, o, heights = bitboard_state(player, board)
+    h, hm = core_nb.zobrist_hashes(p, o, board.rows, board.cols)
+    # forget the entries of earlier searches, see minimax
+    core_nb.clear_transposition_table(core_nb.EXPECTIMAX_TT)
+    placement, _ = core_nb.expectimax_bb(
+        p, o, h, hm, heights, board.rows, board.cols,
+        core_nb.evaluator(board.rows, board.cols), depth_limit, True, core_nb.EXPECTIMAX_TT
+    )
+    return None if placement < 0 else int(placement)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+"""
+Check the bitboard search core against plain list-based implementations.
+
+Run with: python -m unittest test_search
+"""
+import random
+import unittest
+
+import numpy as np
+
+import core_nb
+import four_in_a_row
+from game_gui import Board
+
+
+def reference_evaluate(player, board):
+    """
+    The list-based evaluate the bitboard evaluators replaced
+    """
+    adversary = board.PLAYER2 if player == board.PLAYER1 else board.PLAYER1
+    score = [0] * 5
+    adv_score = [0] * 5
+    weights = [0, 1, 4, 16, 1000]
+    seg = []
+    invalid_slot = -1
+    left_revolved = [
+        [invalid_slot] * r + board.row(r) + [invalid_slot] * (board.rows - 1 - r) for r in range(board.rows)
+    ]
+    right_revolved = [
+        [invalid_slot] * (board.rows - 1 - r) + board.row(r) + [invalid_slot] * r for r in range(board.rows)
+    ]
+    for r in range(board.rows):
+        row = board.row(r)
+        for c in range(board.cols - 3):
+            seg.append(row[c:c + 4])
+    for c in range(board.cols):
+        col = board.col(c)
+        for r in range(board.rows - 3):
+            seg.append(col[r:r + 4])
+    for c in zip(*left_revolved):
+        for r in range(board.rows - 3):
+            seg.append(c[r:r + 4])
+    for c in zip(*right_revolved):
+        for r in range(board.rows - 3):
+            seg.append(c[r:r + 4])
+    for s in seg:
+        if invalid_slot in s:
+            continue
+        if adversary not in s:
+            score[s.count(player)] += 1
+        if player not in s:
+            adv_score[s.count(adversary)] += 1
+    return sum([s * w for s, w in zip(score, weights)]) - sum([s * w for s, w in zip(adv_score, weights)])
+
+
+def reference_value(board, mover, max_player, depth, chance, memo):
+    """
+    The depth-limited minimax value of a board for max_player, or its
+    expectimax value if chance, won positions scoring +-core_nb.INF.
+    memo maps the boards already valued to their values.
+    """
+    key = (board_key(board), mover, depth)
+    if key in memo:
+        return memo[key]
+    winner = board.who_wins()
+    if winner is not None:
+        value = core_nb.INF if winner == max_player else -core_nb.INF
+    elif depth == 0 or board.terminal():
+        value = reference_evaluate(max_player, board)
+    else:
+        values = [
+            reference_value(child, 3 - mover, max_player, depth - 1, chance, memo)
+            for _, child in four_in_a_row.get_child_boards(mover, board)
+        ]
+        if mover == max_player:
+            value = max(values)
+        elif chance:
+            value = sum(values) / len(values)
+        else:
+            value = min(values)
+    memo[key] = value
+    return value
+
+
+def board_key(board):
+    """
+    Get a hashable copy of the slots of a board
+    """
+    return tuple(tuple(board.row(r)) for r in range(board.rows))
+
+
+def move_values(player, board, depth, chance=False):
+    """
+    Get the reference value of every legal column for player
+    """
+    memo = {}
+    return {
+        col: reference_value(child, 3 - player, player, depth - 1, chance, memo)
+        for col, child in four_in_a_row.get_child_boards(player, board)
+    }
+
+
+def random_boards(seed, count, rows=6, cols=7, max_moves=30):
+    """
+    Get count (board, player to move) pairs of random games still going on
+    """
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = Board(rows, cols)
+        player = Board.PLAYER1
+        for _ in range(rng.randrange(max_moves)):
+            if board.terminal():
+                break
+            board.place(player, rng.choice([c for c in range(cols) if board.placeable(c)]))
+            player = 3 - player
+        if not board.terminal():
+            boards.append((board, player))
+    return boards
+
+
+def mirror(board):
+    """
+    Get the mirror image of a board
+    """
+    image = board.clone()
+    for r in range(board.rows):
+        row = board.row(r)
+        for c in range(board.cols):
+            image._board[r][c] = row[board.cols - 1 - c]
+    return image
+
+
+def negamax_search(player, board, depth, prune):
+    """
+    Search a board with core_nb.negamax_bb on a full window, as minimax does,
+    but on the transposition table left by the previous searches
+    """
+    p, o, heights = four_in_a_row.bitboard_state(player, board)
+    h, hm = core_nb.zobrist_hashes(p, o, board.rows, board.cols)
+    killers = np.full((depth + 1, 2), -1, dtype=np.int64)
+    history = np.zeros((2, board.cols), dtype=np.int64)
+    placement, _ = core_nb.negamax_bb(
+        p, o, h, hm, heights, board.rows, board.cols, core_nb.evaluator(board.rows, board.cols),
+        depth, core_nb.WORST, -core_nb.WORST, 0, prune, core_nb.MINIMAX_TT, killers, history
+    )
+    return int(placement)
+
+
+class EvaluateTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        for rows, cols in ((6, 7), (4, 4), (5, 8)):
+            for board, _ in random_boards(rows * cols, 200, rows, cols, rows * cols):
+                for player in (Board.PLAYER1, Board.PLAYER2):
+                    self.assertEqual(four_in_a_row.evaluate(player, board), reference_evaluate(player, board))
+
+    def test_won_board(self):
+        board = Board(6, 7)
+        for c in range(4):
+            board.place(Board.PLAYER1, c)
+        self.assertEqual(four_in_a_row.evaluate(Board.PLAYER1, board), core_nb.INF)
+        self.assertEqual(four_in_a_row.evaluate(Board.PLAYER2, board), -core_nb.INF)
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        core_nb.clear_transposition_tables()
+
+    def assert_optimal(self, search, board, player, depth, chance=False):
+        placement = search(player, board, depth)
+        values = move_values(player, board, depth, chance)
+        self.assertIn(placement, values)
+        best = max(values.values())
+        if chance:
+            # the expectations only differ from the reference by rounding
+            self.assertAlmostEqual(values[placement], best, delta=1e-9 * max(1, abs(best)))
+        else:
+            self.assertEqual(values[placement], best)
+
+    def check_optimal(self, search, depths, chance=False):
+        for board, player in random_boards(1, 12):
+            for depth in depths:
+                core_nb.clear_transposition_tables()
+                self.assert_optimal(search, board, player, depth, chance)
+
+    def test_minimax(self):
+        self.check_optimal(four_in_a_row.minimax, (1, 2, 3))
+
+    def test_alphabeta(self):
+        self.check_optimal(four_in_a_row.alphabeta, (1, 2, 3, 4))
+
+    def test_expectimax(self):
+        self.check_optimal(four_in_a_row.expectimax, (1, 2, 3), chance=True)
+
+    def test_board_sizes(self):
+        # the tables are not cleared between the boards of different sizes,
+        # whose empty boards have the same bitboards
+        searches = ((four_in_a_row.minimax, False), (four_in_a_row.alphabeta, False), (four_in_a_row.expectimax, True))
+        for rows, cols in ((4, 9), (4, 4), (6, 7), (4, 4), (5, 6)):
+            boards = [(Board(rows, cols), Board.PLAYER1)] + random_boards(rows * cols, 3, rows, cols, rows * cols // 2)
+            for board, player in boards:
+                for search, chance in searches:
+                    self.assert_optimal(search, board, player, 3, chance)
+
+    def test_mixed_depths(self):
+        # games where every move is searched by a random search at a random
+        # depth, without clearing the tables in between
+        searches = ((four_in_a_row.minimax, False), (four_in_a_row.alphabeta, False), (four_in_a_row.expectimax, True))
+        rng = random.Random(4)
+        for _ in range(2):
+            board = Board(6, 7)
+            player = Board.PLAYER1
+            for _ in range(10):
+                if board.terminal():
+                    break
+                search, chance = rng.choice(searches)
+                for depth in (4, rng.randrange(1, 4)):
+                    self.assert_optimal(search, board, player, depth, chance)
+                board.place(player, search(player, board, rng.randrange(1, 5)))
+                player = 3 - player
+
+    def test_immediate_win(self):
+        board = Board(6, 7)
+        for c in (0, 1, 0, 1, 0, 1):
+            board.place(Board.PLAYER1 if c == 0 else Board.PLAYER2, c)
+        for search in (four_in_a_row.minimax, four_in_a_row.alphabeta, four_in_a_row.expectimax):
+            self.assertEqual(search(Board.PLAYER1, board, 3), 0)
+
+
+class MirrorTest(unittest.TestCase):
+
+    def test_hashes_swap(self):
+        for board, player in random_boards(2, 20):
+            p, o, _ = four_in_a_row.bitboard_state(player, board)
+            mp, mo, _ = four_in_a_row.bitboard_state(player, mirror(board))
+            h, hm = core_nb.zobrist_hashes(p, o, board.rows, board.cols)
+            self.assertEqual(core_nb.zobrist_hashes(mp, mo, board.rows, board.cols), (hm, h))
+            self.assertEqual(core_nb.tt_key(h, hm, True), core_nb.tt_key(hm, h, True))
+
+    def test_mirror_entries(self):
+        # the mirror image is searched on the table filled by the original board,
+        # so its moves come from the mirrored entries
+        for board, player in random_boards(3, 12, max_moves=20):
+            image = mirror(board)
+            for depth in (2, 4):
+                values = move_values(player, image, depth)
+                for prune in (False, True):
+                    core_nb.clear_transposition_tables()
+                    negamax_search(player, board, depth, prune)
+                    placement = negamax_search(player, image, depth, prune)
+                    self.assertIn(placement, values)
+                    self.assertEqual(values[placement], max(values.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()